@@ -1,12 +1,17 @@
 import os
+import signal
 import time
 import hashlib
+import json
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import blake3
 import dropbox
 import requests
 import pid
-from dropbox.exceptions import ApiError, AuthError
-from dropbox.files import WriteMode
+from dropbox.exceptions import ApiError, AuthError, DropboxException
+from dropbox.files import CommitInfo, UploadSessionAppendError, UploadSessionCursor, UploadSessionFinishArg, WriteMode
 from dotenv import load_dotenv
 from backup_logger import logger
 
@@ -22,113 +27,400 @@ DROPBOX_REFRESH_TOKEN = os.getenv("DROPBOX_REFRESH_TOKEN")
 APP_KEY = os.getenv("APP_KEY")
 APP_SECRET = os.getenv("APP_SECRET")
 
+# Local-only sidecar in WATCH_FOLDER; never uploaded
+STAT_CACHE_NAME = ".checksums_cache.json"
+
+# Files modified this close to the scan are not stat-cached; they could be rewritten
+# within the same timestamp tick without their mtime changing (git's "racy" rule)
+RACY_WINDOW_NS = 2 * 1000 * 1000 * 1000
+
+# Files are written to this suffix first, then renamed into place
+TMP_SUFFIX = ".tmp"
+
+# Bookkeeping files in WATCH_FOLDER that are never uploaded
+LOCAL_FILES = frozenset({STAT_CACHE_NAME, STAT_CACHE_NAME + TMP_SUFFIX, "checksums.txt" + TMP_SUFFIX})
+
+# First line of checksums.txt; files without it hold legacy MD5 checksums
+CHECKSUMS_HEADER = "#blake3"
+
+# Files are hashed concurrently; reads and hashing release the GIL
+HASH_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# Concurrent Dropbox uploads per cycle
+UPLOAD_WORKERS = 8
+
+# Upload sessions are appended in chunks of this size
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# Large uploads log their progress every this many chunks
+PROGRESS_LOG_CHUNKS = 16
+
+# Maximum number of entries files_upload_session_finish_batch_v2 accepts
+FINISH_BATCH_SIZE = 1000
+
+# Read buffer used when hashing files
+HASH_BUFFER_SIZE = 1024 * 1024
+
 
 
 # Dropbox client abstraction
 class DropboxClient:
     def __init__(self, dbx):
         self.dbx = dbx
+        self._local = threading.local()
+
+    # The SDK client is not reentrant, so each upload thread gets its own clone
+    # (sharing the same connection pool)
+    def _client(self):
+        dbx = getattr(self._local, "dbx", None)
+        if dbx is None:
+            dbx = self._local.dbx = self.dbx.clone()
+        return dbx
 
-    def upload(self, file_path, dropbox_path): # pragma: no cover
+    # Logs an ApiError raised by files_upload_session_append_v2
+    def _log_append_error(self, file_path, err):
+        error = err.error
+        if isinstance(error, UploadSessionAppendError) and error.is_not_found():
+            logger.error(f"Failed to upload {file_path}: upload session not found or expired.")
+        elif isinstance(error, UploadSessionAppendError) and error.is_incorrect_offset():
+            logger.error(f"Failed to upload {file_path}: incorrect upload session offset.")
+        elif err.user_message_text:
+            logger.error(f"Failed to upload {file_path}: {err.user_message_text}")
+        else:
+            logger.error(f"Failed to upload {file_path}: {error}")
+
+    # Logs an UploadSessionFinishError returned by files_upload_session_finish_batch_v2
+    def _log_finish_error(self, file_path, error):
+        if error.is_path() and error.get_path().is_insufficient_space():
+            logger.error("ERROR: Cannot back up; insufficient space.")
+        else:
+            logger.error(f"Failed to commit {file_path}: {error}")
+
+    # Streams one file into an upload session and closes it, returning its size and
+    # the checksum of the bytes uploaded, so the file is only read once
+    def _upload_session(self, file_path, session_id):
+        dbx = self._client()
+        hasher = blake3.blake3()
         with open(file_path, 'rb') as f:
-            logger.info(f"Uploading {file_path} to Dropbox as {dropbox_path}...")
+            file_size = os.fstat(f.fileno()).st_size
+            offset = 0
+            chunk_index = 0
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                close = len(chunk) < CHUNK_SIZE or offset + len(chunk) >= file_size
+                logger.debug("Appending %s to upload session at offset %d", file_path, offset)
+                if chunk_index and chunk_index % PROGRESS_LOG_CHUNKS == 0:
+                    logger.info("Uploading %s: %d of %d bytes", file_path, offset, file_size)
+                chunk_index += 1
+                dbx.files_upload_session_append_v2(chunk, UploadSessionCursor(session_id, offset), close=close)
+                hasher.update(chunk)
+                offset += len(chunk)
+                if close:
+                    return offset, hasher.hexdigest()
+
+    # Uploads (file_path, dropbox_path) pairs, committing up to 1000 files per API call.
+    # Returns {file_path: checksum} for the files that were uploaded, even if a later
+    # batch fails, so the caller can always record what succeeded.
+    def upload_batch(self, items):
+        uploaded = {}
+        for start in range(0, len(items), FINISH_BATCH_SIZE):
+            batch = items[start:start + FINISH_BATCH_SIZE]
+            try:
+                session_ids = self.dbx.files_upload_session_start_batch(len(batch)).session_ids
+            except (DropboxException, requests.RequestException) as err:
+                logger.error(f"Failed to start upload sessions: {err}")
+                return uploaded
+
+            finished = []
+            with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+                futures = {}
+                for (file_path, dropbox_path), session_id in zip(batch, session_ids):
+                    logger.info(f"Uploading {file_path} to Dropbox as {dropbox_path}...")
+                    future = executor.submit(self._upload_session, file_path, session_id)
+                    futures[future] = (file_path, dropbox_path, session_id)
+                for future in as_completed(futures):
+                    file_path, dropbox_path, session_id = futures[future]
+                    try:
+                        size, checksum = future.result()
+                    except ApiError as err:
+                        self._log_append_error(file_path, err)
+                        continue
+                    except (DropboxException, requests.RequestException) as err:
+                        logger.error(f"Failed to upload {file_path}: {err}")
+                        continue
+                    except OSError as err:
+                        logger.error(f"Cannot read {file_path}: {err}")
+                        continue
+                    finished.append((file_path, checksum, UploadSessionFinishArg(
+                        UploadSessionCursor(session_id, size),
+                        CommitInfo(dropbox_path, mode=WriteMode('overwrite')),
+                    )))
+
+            if not finished:
+                continue
             try:
-                self.dbx.files_upload(f.read(), dropbox_path, mode=WriteMode('overwrite'))
-            except ApiError as err:
-                if err.error.is_path() and err.error.get_path().reason.is_insufficient_space():
-                    logger.error("ERROR: Cannot back up; insufficient space.")
-                    raise err
-                elif err.user_message_text:
-                    logger.error(err.user_message_text)
-                    raise err
+                result = self.dbx.files_upload_session_finish_batch_v2([arg for _, _, arg in finished])
+            except (DropboxException, requests.RequestException) as err:
+                logger.error(f"Failed to commit upload batch: {err}")
+                return uploaded
+            for (file_path, checksum, _), entry in zip(finished, result.entries):
+                if entry.is_failure():
+                    self._log_finish_error(file_path, entry.get_failure())
                 else:
-                    logger.error(err)
-                    raise err
+                    uploaded[file_path] = checksum
+        return uploaded
 
-# Function to calculate the MD5 checksum of a file
+# Function to feed a file through one or more hashers in a single read pass.
+# Files are read rather than mmapped: a file truncated while mapped would SIGBUS the daemon.
+def hash_file(file_path, *hashers):
+    buf = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buf)
+    with open(file_path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            for hasher in hashers:
+                hasher.update(view[:n])
+    return [hasher.hexdigest() for hasher in hashers]
+
+# Function to calculate the BLAKE3 checksum of a file
+def calculate_checksum(file_path):
+    return hash_file(file_path, blake3.blake3())[0]
+
+# Function to calculate the MD5 checksum of a file, used to migrate legacy checksums
 def calculate_md5(file_path):
-    hash_md5 = hashlib.md5()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+    with open(file_path, "rb", buffering=0) as f:
+        if hasattr(hashlib, "file_digest"):
+            # Python 3.11+: the whole read/update loop runs in C
+            return hashlib.file_digest(f, "md5").hexdigest()
+        hash_md5 = hashlib.md5()
+        buf = bytearray(HASH_BUFFER_SIZE)
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            hash_md5.update(view[:n])
+        return hash_md5.hexdigest()
 
-# Function to read checksums from a file
+# Function to read checksums from a file.
+# Returns (checksums, legacy); legacy files have no header and hold MD5 checksums.
 def read_checksums(file_path):
     checksums = {}
+    legacy = False
     if os.path.exists(file_path):
         with open(file_path, "r") as f:
+            legacy = f.readline().strip() != CHECKSUMS_HEADER
+            if legacy:
+                f.seek(0)
             for line in f:
-                splits = line.strip().split()
-                file_md5 = splits[-1]
-                file_name = line.replace(file_md5, "").strip()
-                # file_name, file_md5 = line.strip().split()
-                checksums[file_name] = file_md5
-    return checksums
+                line = line.strip()
+                # The checksum is the last field; file names may contain spaces
+                splits = line.rsplit(maxsplit=1)
+                if len(splits) == 2:
+                    checksums[splits[0]] = splits[1]
+    return checksums, legacy
+
+# Function to replace a file's contents atomically, so a crash never leaves it truncated
+def write_atomic(file_path, data):
+    tmp_path = file_path + TMP_SUFFIX
+    with open(tmp_path, "w") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
 
 # Function to write checksums to a file
 def write_checksums(file_path, checksums):
-    with open(file_path, "w") as f:
-        for file_name, file_md5 in checksums.items():
-            f.write(f"{file_name} {file_md5}\n")
+    lines = [f"{CHECKSUMS_HEADER}\n"]
+    lines.extend(f"{file_name} {checksums[file_name]}\n" for file_name in sorted(checksums))
+    write_atomic(file_path, "".join(lines))
+
+# Function to read ignored file names into a set for constant-time lookups.
+# Blank lines and '#' comments are skipped; "./name" and "name" are the same entry.
+def read_ignore(file_path):
+    ignore = set()
+    if os.path.exists(file_path):
+        with open(file_path) as f:
+            for line in f:
+                name = line.strip()
+                if name.startswith("./"):
+                    name = name[2:]
+                if name and not name.startswith("#"):
+                    ignore.add(name)
+    return frozenset(ignore)
+
+# Function to check a stat cache entry has the [checksum, size, mtime_ns, inode] shape
+def is_stat_cache_entry(entry):
+    return (
+        isinstance(entry, list) and len(entry) == 4 and isinstance(entry[0], str)
+        and all(isinstance(x, int) and not isinstance(x, bool) for x in entry[1:])
+    )
+
+# Function to read the (size, mtime_ns, inode) -> checksum stat cache
+def read_stat_cache(file_path):
+    if os.path.exists(file_path):
+        try:
+            with open(file_path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            logger.warning(f"Ignoring unreadable stat cache {file_path}")
+            return {}
+        # Caches written with another hash algorithm are discarded
+        if isinstance(data, dict) and data.get("algorithm") == "blake3":
+            files = data.get("files")
+            if isinstance(files, dict) and all(is_stat_cache_entry(x) for x in files.values()):
+                return files
+            logger.warning(f"Ignoring corrupt stat cache {file_path}")
+    return {}
+
+# Function to write the stat cache
+def write_stat_cache(file_path, stat_cache):
+    write_atomic(file_path, json.dumps({"algorithm": "blake3", "files": stat_cache}))
 
 # Main function to monitor the folder and upload changed files
 def monitor_and_upload(dropbox_client):
     checksums_file = os.path.join(WATCH_FOLDER, "checksums.txt")
+    stat_cache_file = os.path.join(WATCH_FOLDER, STAT_CACHE_NAME)
 
     # Read existing checksums
-    old_checksums = read_checksums(checksums_file)
+    old_checksums, legacy_checksums = read_checksums(checksums_file)
     new_checksums = {}
+
+    # Files whose size, mtime and inode are unchanged reuse their cached checksum.
+    # Legacy checksums need every file's MD5, so the cache is not used while migrating.
+    old_stat_cache = {} if legacy_checksums else read_stat_cache(stat_cache_file)
+    new_stat_cache = {}
     
     # Load ignore file
-    ignore_file = os.path.join(WATCH_FOLDER, "ignore.txt")
-    ignore = []
-    if os.path.exists(ignore_file):
-        with open(ignore_file) as f:
-            ignore = [x.strip() for x in f.readlines()]
-
-
-    # Calculate new checksums and compare with old ones
-    for file_name in os.listdir(WATCH_FOLDER):
-        file_path = os.path.join(WATCH_FOLDER, file_name)
-        if os.path.isfile(file_path) and file_name not in ignore:
-            file_md5 = calculate_md5(file_path)
-            new_checksums[file_name] = file_md5
-            if old_checksums.get(file_name) != file_md5:
-                dropbox_path = os.path.join(DROPBOX_FOLDER, file_name)
-                logger.info("Calling upload")
-                logger.info(file_path)
-                logger.info(dropbox_path)
-                dropbox_client.upload(file_path, dropbox_path)
+    ignore = read_ignore(os.path.join(WATCH_FOLDER, "ignore.txt"))
+
+
+    # Stat every file, reusing cached checksums where possible.
+    # scandir reports the file type from readdir, so only regular files are stat'ed
+    stat_keys = {}
+    local_paths = {}
+    to_hash = []
+    changed_files = []
+    racy_cutoff_ns = time.time_ns() - RACY_WINDOW_NS
+    with os.scandir(WATCH_FOLDER) as entries:
+        for entry in entries:
+            file_name = entry.name
+            if file_name in LOCAL_FILES or file_name in ignore:
+                continue
+            try:
+                if not entry.is_file():
+                    continue
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            stat_key = [st.st_size, st.st_mtime_ns, st.st_ino]
+            stat_keys[file_name] = stat_key
+            local_paths[file_name] = entry.path
+            cached = old_stat_cache.get(file_name)
+            if cached and cached[1:] == stat_key:
+                new_checksums[file_name] = cached[0]
+            elif file_name not in old_checksums or (
+                    cached and cached[0] == old_checksums[file_name] and cached[1] != st.st_size):
+                # New, or resized since it was uploaded: certainly changed, so skip
+                # the comparison hash and hash it while uploading instead
+                changed_files.append(file_name)
+            else:
+                to_hash.append(file_name)
+
+    # Hash the remaining files in parallel; when migrating legacy checksums the
+    # MD5 is computed from the same read
+    legacy_md5s = {}
+    if to_hash:
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+            if legacy_checksums:
+                futures = {executor.submit(hash_file, local_paths[x], blake3.blake3(), hashlib.md5()): x for x in to_hash}
+            else:
+                futures = {executor.submit(calculate_checksum, local_paths[x]): x for x in to_hash}
+            for future in as_completed(futures):
+                file_name = futures[future]
+                try:
+                    if legacy_checksums:
+                        new_checksums[file_name], legacy_md5s[file_name] = future.result()
+                    else:
+                        new_checksums[file_name] = future.result()
+                except (FileNotFoundError, PermissionError) as err:
+                    # Deleted or made unreadable since the scan; retried next cycle
+                    logger.warning(f"Cannot hash {file_name}: {err}")
+                    del stat_keys[file_name]
+
+    # Compare with old checksums and queue changed files for upload
+    upload_queue = [(x, local_paths[x], os.path.join(DROPBOX_FOLDER, x)) for x in changed_files]
+    for file_name, file_checksum in new_checksums.items():
+        new_stat_cache[file_name] = [file_checksum] + stat_keys[file_name]
+
+        old_checksum = old_checksums.get(file_name)
+        if legacy_checksums and old_checksum is not None:
+            # Legacy MD5 entry: only upload if the content really changed
+            changed = legacy_md5s[file_name] != old_checksum
+        else:
+            changed = old_checksum != file_checksum
+        if changed:
+            upload_queue.append((file_name, local_paths[file_name], os.path.join(DROPBOX_FOLDER, file_name)))
+        else:
+            logger.debug("File stayed the same:%s", file_name)
+
+    # Upload as a batch; failed files keep their old checksum so they are retried
+    if upload_queue:
+        logger.info("Calling upload")
+        uploaded = dropbox_client.upload_batch([(file_path, dropbox_path) for _, file_path, dropbox_path in upload_queue])
+        for file_name, file_path, _ in upload_queue:
+            if file_path in uploaded:
+                new_checksums[file_name] = uploaded[file_path]
+                new_stat_cache[file_name] = [uploaded[file_path]] + stat_keys[file_name]
                 logger.info(f"Uploaded {file_name} to Dropbox.")
+            elif file_name in old_checksums:
+                new_checksums[file_name] = old_checksums[file_name]
             else:
-                logger.debug(f"File stayed the same:{file_name}")
+                new_checksums.pop(file_name, None)
+
+    # Drop racy entries so those files are rehashed next cycle
+    new_stat_cache = {k: v for k, v in new_stat_cache.items() if v[2] < racy_cutoff_ns}
 
     # Write new checksums to file
     write_checksums(checksums_file, new_checksums)
+    write_stat_cache(stat_cache_file, new_stat_cache)
 
-def main(): # pragma: no cover
+# Creates the Dropbox client once; its session keeps connections alive across cycles
+def create_client(): # pragma: no cover
     if not WATCH_FOLDER or not DROPBOX_FOLDER or not DROPBOX_TOKEN or not DROPBOX_REFRESH_TOKEN or not APP_KEY or not APP_SECRET:
         logger.error("Please set WATCH_FOLDER, DROPBOX_FOLDER, DROPBOX_TOKEN, DROPBOX_REFRESH_TOKEN, APP_KEY, and APP_SECRET environment variables.")
         sys.exit(1)
 
-    with dropbox.Dropbox(
+    dbx = dropbox.Dropbox(
         oauth2_access_token= DROPBOX_TOKEN,
         oauth2_refresh_token=DROPBOX_REFRESH_TOKEN,
         app_key = APP_KEY,
-        app_secret = APP_SECRET
-    ) as dbx:
-        dbx.users_get_current_account()
-        
-        dropbox_client = DropboxClient(dbx)
-        monitor_and_upload(dropbox_client)
-        logger.info("Done!")
+        app_secret = APP_SECRET,
+        session=dropbox.create_session(max_connections=UPLOAD_WORKERS)
+    )
+    dbx.users_get_current_account()
+    return DropboxClient(dbx)
+
+def run_once(dropbox_client): # pragma: no cover
+    monitor_and_upload(dropbox_client)
+    logger.info("Done!")
+
+# Function to turn SIGTERM into SystemExit, so atexit stops the log queue listener and flushes queued records
+def handle_sigterm(signum, frame):
+    raise SystemExit(0)
+
+def main(): # pragma: no cover
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    dropbox_client = create_client()
+    while True:
+        run_once(dropbox_client)
+        logger.info("Sleeping...")
+        time.sleep(60)
 
 if __name__ == "__main__": # pragma: no cover
     logger.info("Starting up up...")
 
     with pid.PidFile():
-        while True:
-            main()
-            logger.info("Sleeping...")
-            time.sleep(60)
+        main()
@@ -1,6 +1,8 @@
+import atexit
 import logging
 import logging.handlers
 import os
+import queue
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -30,6 +32,13 @@ file_handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=10485760,
 file_handler.setLevel(level)
 file_handler.setFormatter(formatter)
 
+# Records are queued and written by a listener thread, so upload threads never block on disk
+log_queue = queue.Queue()
+queue_handler = logging.handlers.QueueHandler(log_queue)
+queue_handler.setLevel(level)
+queue_listener = logging.handlers.QueueListener(log_queue, stderr_handler, file_handler, respect_handler_level=True)
+queue_listener.start()
+atexit.register(queue_listener.stop)
+
 # Add handlers to the logger
-logger.addHandler(stderr_handler)
-logger.addHandler(file_handler)
+logger.addHandler(queue_handler)
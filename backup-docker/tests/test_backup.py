@@ -1,10 +1,90 @@
 import os
+import signal
 import tempfile
 import pytest
 import hashlib
+import logging
+import logging.handlers
+import threading
+import blake3
 from unittest.mock import MagicMock
-from backup import calculate_md5, read_checksums, write_checksums, monitor_and_upload, DropboxClient
+import requests
+from dropbox.exceptions import ApiError, InternalServerError
+from dropbox.files import (
+    UploadSessionAppendError,
+    UploadSessionFinishBatchResult,
+    UploadSessionFinishBatchResultEntry,
+    UploadSessionFinishError,
+    UploadSessionOffsetError,
+    WriteError,
+)
+from backup import calculate_checksum, calculate_md5, read_checksums, read_ignore, write_checksums, monitor_and_upload, DropboxClient
 import backup
+import backup_logger
+
+# Helper returning every (file_path, dropbox_path) passed to upload_batch
+def uploaded(dropbox_client):
+    return [item for call in dropbox_client.upload_batch.call_args_list for item in call.args[0]]
+
+# Helper moving a file's mtime out of the racy window so it can be stat-cached
+def age(file_path):
+    past = os.stat(file_path).st_mtime_ns - 10 * backup.RACY_WINDOW_NS
+    os.utime(file_path, ns=(past, past))
+
+# Helper standing in for DropboxClient.upload_batch, succeeding for every file
+def upload_batch(items):
+    result = {}
+    for file_path, _ in items:
+        with open(file_path, "rb") as f:
+            result[file_path] = blake3.blake3(f.read()).hexdigest()
+    return result
+
+# Fixture pointing WATCH_FOLDER at a temporary directory and DROPBOX_FOLDER at /dropbox_folder
+@pytest.fixture
+def watch_folder(monkeypatch):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        monkeypatch.setattr(backup, "WATCH_FOLDER", temp_dir)
+        monkeypatch.setattr(backup, "DROPBOX_FOLDER", "/dropbox_folder")
+        yield temp_dir
+
+# Fixture providing a Dropbox client whose uploads all succeed
+@pytest.fixture
+def dropbox_client():
+    client = MagicMock()
+    client.upload_batch.side_effect = upload_batch
+    return client
+
+# Test calculate_checksum function
+def test_calculate_checksum():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file.write(b"test data")
+        temp_file.close()
+        assert calculate_checksum(temp_file.name) == blake3.blake3(b"test data").hexdigest()
+        os.remove(temp_file.name)
+
+# Test that calculate_checksum survives a file shrinking while it is hashed
+def test_calculate_checksum_truncated(monkeypatch):
+    monkeypatch.setattr(backup, "HASH_BUFFER_SIZE", 4)
+    real_blake3 = blake3.blake3
+    class TruncatingHasher:
+        def __init__(self):
+            self.hasher = real_blake3()
+            self.truncated = False
+        def update(self, data):
+            if not self.truncated:
+                self.truncated = True
+                with open(temp_file.name, "r+b") as f:
+                    f.truncate(6)
+            self.hasher.update(data)
+        def hexdigest(self):
+            return self.hasher.hexdigest()
+    monkeypatch.setattr(backup.blake3, "blake3", TruncatingHasher)
+
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file.write(b"0123456789abcdef")
+        temp_file.close()
+        assert calculate_checksum(temp_file.name) == real_blake3(b"012345").hexdigest()
+        os.remove(temp_file.name)
 
 # Test calculate_md5 function
 def test_calculate_md5():
@@ -19,8 +99,25 @@ def test_read_checksums():
     with tempfile.NamedTemporaryFile(delete=False) as temp_file:
         temp_file.write(b"file1 abcdef1234567890\nfile2 1234567890abcdef\n")
         temp_file.close()
-        checksums = read_checksums(temp_file.name)
+        checksums, legacy = read_checksums(temp_file.name)
         assert checksums == {"file1": "abcdef1234567890", "file2": "1234567890abcdef"}
+        assert legacy
+        os.remove(temp_file.name)
+
+# Test read_checksums with spaces and checksums inside file names
+def test_read_checksums_file_names():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file.write(b"my file abc abc\nabc.txt abc\n\n")
+        temp_file.close()
+        assert read_checksums(temp_file.name)[0] == {"my file abc": "abc", "abc.txt": "abc"}
+        os.remove(temp_file.name)
+
+# Test that read_checksums skips the format header
+def test_read_checksums_header():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file.write(f"{backup.CHECKSUMS_HEADER}\nfile1 abcdef1234567890\n".encode())
+        temp_file.close()
+        assert read_checksums(temp_file.name) == ({"file1": "abcdef1234567890"}, False)
         os.remove(temp_file.name)
 
 # Test write_checksums function
@@ -31,42 +128,440 @@ def test_write_checksums():
         temp_file.close()
         with open(temp_file.name, "r") as f:
             lines = f.readlines()
-            assert lines == ["file1 abcdef1234567890\n", "file2 1234567890abcdef\n"]
+            assert lines == [f"{backup.CHECKSUMS_HEADER}\n", "file1 abcdef1234567890\n", "file2 1234567890abcdef\n"]
         os.remove(temp_file.name)
 
+# Test that write_checksums sorts entries and leaves no temporary file behind
+def test_write_checksums_atomic():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        checksums_file = os.path.join(temp_dir, "checksums.txt")
+        write_checksums(checksums_file, {"file2": "1234567890abcdef", "file1": "abcdef1234567890"})
+        assert os.listdir(temp_dir) == ["checksums.txt"]
+        with open(checksums_file, "r") as f:
+            assert f.readlines()[1:] == ["file1 abcdef1234567890\n", "file2 1234567890abcdef\n"]
+
 # Test monitor_and_upload function
-def test_monitor_and_upload(monkeypatch):
+def test_monitor_and_upload(watch_folder, dropbox_client):
+    temp_dir = watch_folder
+    file1_path = os.path.join(temp_dir, "file1")
+    file2_path = os.path.join(temp_dir, "file2")
+    checksums_file = os.path.join(temp_dir, "checksums.txt")
+    
+    with open(file1_path, "w") as f:
+        f.write("test data 1")
+    with open(file2_path, "w") as f:
+        f.write("test data 2")
+    with open(checksums_file, "w") as f:
+        f.write(f"file1 {backup.calculate_md5(file1_path)}\n")
+
+    backup.monitor_and_upload(dropbox_client)
+
+    # Ensure that file1 (legacy MD5 entry, unchanged) was not uploaded
+    assert file1_path not in [file_path for file_path, _ in uploaded(dropbox_client)]
+
+    # Ensure that file2 was uploaded
+    assert (file2_path, os.path.join("/dropbox_folder", "file2")) in uploaded(dropbox_client)
+    
+    # Ensure that checksums.txt was uploaded
+    assert (checksums_file, os.path.join("/dropbox_folder", "checksums.txt")) in uploaded(dropbox_client)
+    
+    # Ensure checksums.txt is updated with new checksums
+    with open(checksums_file, "r") as f:
+        lines = f.readlines()
+        assert lines[0] == f"{backup.CHECKSUMS_HEADER}\n"
+        lines = lines[1:]
+        assert len(lines) == 3
+        splits = [x.split(" ")[0] for x in lines]
+        assert "checksums.txt" in splits
+        assert "file1" in splits
+        assert "file2" in splits
+
+# Test that unchanged files reuse the stat cache instead of being rehashed
+def test_monitor_and_upload_stat_cache(monkeypatch, watch_folder, dropbox_client):
+    temp_dir = watch_folder
+    file1_path = os.path.join(temp_dir, "file1")
+    with open(file1_path, "w") as f:
+        f.write("test data 1")
+    age(file1_path)
+
+    backup.monitor_and_upload(dropbox_client)
+    assert os.path.exists(os.path.join(temp_dir, backup.STAT_CACHE_NAME))
+
+    hashed = []
+    real_calculate_checksum = backup.calculate_checksum
+    def spy(file_path):
+        hashed.append(os.path.basename(file_path))
+        return real_calculate_checksum(file_path)
+    monkeypatch.setattr(backup, "calculate_checksum", spy)
+
+    backup.monitor_and_upload(dropbox_client)
+
+    # Nothing needs rehashing; checksums.txt is new and hashed while uploading
+    assert hashed == []
+    for file_path, _ in uploaded(dropbox_client):
+        assert os.path.basename(file_path) != backup.STAT_CACHE_NAME
+
+    # Modifying a file without resizing it invalidates its cache entry
+    with open(file1_path, "w") as f:
+        f.write("test data 2")
+    age(file1_path)
+    hashed.clear()
+    backup.monitor_and_upload(dropbox_client)
+    assert "file1" in hashed
+    assert (file1_path, os.path.join("/dropbox_folder", "file1")) in uploaded(dropbox_client)
+
+    # A resized file is uploaded without being hashed first
+    with open(file1_path, "w") as f:
+        f.write("test data 1 changed")
+    hashed.clear()
+    dropbox_client.upload_batch.reset_mock()
+    backup.monitor_and_upload(dropbox_client)
+    assert "file1" not in hashed
+    assert (file1_path, os.path.join("/dropbox_folder", "file1")) in uploaded(dropbox_client)
+    with open(file1_path, "rb") as f:
+        assert read_checksums(os.path.join(temp_dir, "checksums.txt"))[0]["file1"] == blake3.blake3(f.read()).hexdigest()
+
+# Test calculate_md5 fallback for Pythons without hashlib.file_digest
+def test_calculate_md5_fallback(monkeypatch):
+    monkeypatch.delattr(hashlib, "file_digest", raising=False)
+    monkeypatch.setattr(backup, "HASH_BUFFER_SIZE", 4)
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file.write(b"test data spanning several buffers")
+        temp_file.close()
+        assert calculate_md5(temp_file.name) == hashlib.md5(b"test data spanning several buffers").hexdigest()
+        os.remove(temp_file.name)
+
+# Test that legacy migration hashes BLAKE3 and MD5 in one pass and tolerates vanished files
+def test_monitor_and_upload_legacy_single_pass(monkeypatch, watch_folder, dropbox_client):
+    temp_dir = watch_folder
+    file1_path = os.path.join(temp_dir, "file1")
+    file2_path = os.path.join(temp_dir, "file2")
+    with open(file1_path, "w") as f:
+        f.write("test data 1")
+    with open(file2_path, "w") as f:
+        f.write("test data 2")
+    with open(os.path.join(temp_dir, "checksums.txt"), "w") as f:
+        f.write(f"file1 {calculate_md5(file1_path)}\nfile2 {calculate_md5(file2_path)}\n")
+
+    reads = []
+    real_hash_file = backup.hash_file
+    def hash_file(file_path, *hashers):
+        reads.append(file_path)
+        if file_path == file2_path:
+            raise FileNotFoundError(file_path)
+        return real_hash_file(file_path, *hashers)
+    monkeypatch.setattr(backup, "hash_file", hash_file)
+    monkeypatch.setattr(backup, "calculate_md5", MagicMock(side_effect=AssertionError("second read")))
+
+    backup.monitor_and_upload(dropbox_client)
+
+    assert sorted(reads) == [file1_path, file2_path]
+    assert file1_path not in [file_path for file_path, _ in uploaded(dropbox_client)]
+    checksums, legacy = read_checksums(os.path.join(temp_dir, "checksums.txt"))
+    assert not legacy
+    assert checksums["file1"] == blake3.blake3(b"test data 1").hexdigest()
+    assert "file2" not in checksums
+
+# Test that MD5-length entries are only treated as MD5 when the header is missing
+def test_monitor_and_upload_header_not_legacy(watch_folder, dropbox_client):
+    temp_dir = watch_folder
+    file1_path = os.path.join(temp_dir, "file1")
+    with open(file1_path, "w") as f:
+        f.write("test data 1")
+    with open(os.path.join(temp_dir, "checksums.txt"), "w") as f:
+        f.write(f"{backup.CHECKSUMS_HEADER}\nfile1 {calculate_md5(file1_path)}\n")
+
+    backup.monitor_and_upload(dropbox_client)
+
+    assert (file1_path, os.path.join("/dropbox_folder", "file1")) in uploaded(dropbox_client)
+
+# Test that malformed or unreadable stat caches are ignored
+@pytest.mark.parametrize("contents", [
+    '{"algorithm": "blake3", "files": {"file1": ["abc", 1, 2]}}',
+    '{"algorithm": "blake3", "files": {"file1": "abc"}}',
+    '{"algorithm": "blake3", "files": {"file1": [1, 2, 3, 4]}}',
+    '{"algorithm": "blake3", "files": []}',
+])
+def test_read_stat_cache_malformed(contents):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        stat_cache_file = os.path.join(temp_dir, backup.STAT_CACHE_NAME)
+        with open(stat_cache_file, "w") as f:
+            f.write(contents)
+        assert backup.read_stat_cache(stat_cache_file) == {}
+
+        # A directory in its place cannot be opened
+        os.remove(stat_cache_file)
+        os.mkdir(stat_cache_file)
+        assert backup.read_stat_cache(stat_cache_file) == {}
+
+# Test that files modified right before the scan are not stat-cached
+def test_monitor_and_upload_racy_entry(watch_folder, dropbox_client):
+    temp_dir = watch_folder
+    file1_path = os.path.join(temp_dir, "file1")
+    with open(file1_path, "w") as f:
+        f.write("test data 1")
+    mtime_ns = os.stat(file1_path).st_mtime_ns
+
+    backup.monitor_and_upload(dropbox_client)
+    assert "file1" not in backup.read_stat_cache(os.path.join(temp_dir, backup.STAT_CACHE_NAME))
+
+    # Rewritten at the same size within the same timestamp tick
+    with open(file1_path, "w") as f:
+        f.write("test data 2")
+    os.utime(file1_path, ns=(mtime_ns, mtime_ns))
+    dropbox_client.upload_batch.reset_mock()
+    backup.monitor_and_upload(dropbox_client)
+
+    assert (file1_path, os.path.join("/dropbox_folder", "file1")) in uploaded(dropbox_client)
+    assert read_checksums(os.path.join(temp_dir, "checksums.txt"))[0]["file1"] == blake3.blake3(b"test data 2").hexdigest()
+
+# Test that a file vanishing between the scan and hashing is skipped
+def test_monitor_and_upload_hash_race(monkeypatch, watch_folder, dropbox_client):
+    temp_dir = watch_folder
+    file1_path = os.path.join(temp_dir, "file1")
+    file2_path = os.path.join(temp_dir, "file2")
+    with open(file1_path, "w") as f:
+        f.write("test data 1")
+    with open(file2_path, "w") as f:
+        f.write("test data 2")
+    with open(os.path.join(temp_dir, "checksums.txt"), "w") as f:
+        f.write(f"{backup.CHECKSUMS_HEADER}\nfile1 old\nfile2 old\n")
+
+    real_calculate_checksum = backup.calculate_checksum
+    def calculate_checksum(file_path):
+        if file_path == file2_path:
+            raise PermissionError("permission denied")
+        return real_calculate_checksum(file_path)
+    monkeypatch.setattr(backup, "calculate_checksum", calculate_checksum)
+
+    backup.monitor_and_upload(dropbox_client)
+
+    file_paths = [file_path for file_path, _ in uploaded(dropbox_client)]
+    assert file1_path in file_paths
+    assert file2_path not in file_paths
+    assert "file2" not in read_checksums(os.path.join(temp_dir, "checksums.txt"))[0]
+
+# Test that a failed upload is not recorded, so it is retried next cycle
+def test_monitor_and_upload_failure(watch_folder, dropbox_client):
+    temp_dir = watch_folder
+    file1_path = os.path.join(temp_dir, "file1")
+    file2_path = os.path.join(temp_dir, "file2")
+    with open(file1_path, "w") as f:
+        f.write("test data 1")
+    with open(file2_path, "w") as f:
+        f.write("test data 2")
+
+    dropbox_client.upload_batch.side_effect = lambda items: {
+        file_path: checksum for file_path, checksum in upload_batch(items).items() if file_path != file2_path
+    }
+
+    backup.monitor_and_upload(dropbox_client)
+
+    checksums = read_checksums(os.path.join(temp_dir, "checksums.txt"))[0]
+    assert "file1" in checksums
+    assert "file2" not in checksums
+
+# Test DropboxClient.upload_batch against a mocked SDK client
+def test_upload_batch(monkeypatch):
+    monkeypatch.setattr(backup, "CHUNK_SIZE", 4)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        small_path = os.path.join(temp_dir, "small")
+        large_path = os.path.join(temp_dir, "large")
+        missing_path = os.path.join(temp_dir, "missing")
+        with open(small_path, "wb") as f:
+            f.write(b"abc")
+        with open(large_path, "wb") as f:
+            f.write(b"0123456789")
+
+        dbx = MagicMock()
+        dbx.clone.return_value = dbx
+        dbx.files_upload_session_start_batch.return_value.session_ids = ["s1", "s2", "s3"]
+        dbx.files_upload_session_finish_batch_v2.side_effect = lambda entries: MagicMock(
+            entries=[MagicMock(**{"is_failure.return_value": e.commit.path == "/d/large"}) for e in entries]
+        )
+
+        result = DropboxClient(dbx).upload_batch([
+            (small_path, "/d/small"),
+            (large_path, "/d/large"),
+            (missing_path, "/d/missing"),
+        ])
+        assert result == {small_path: blake3.blake3(b"abc").hexdigest()}
+
+        appends = [(c.args[0], c.args[1].session_id, c.args[1].offset, c.kwargs["close"])
+                   for c in dbx.files_upload_session_append_v2.call_args_list]
+        assert sorted(appends) == sorted([
+            (b"abc", "s1", 0, True),
+            (b"0123", "s2", 0, False),
+            (b"4567", "s2", 4, False),
+            (b"89", "s2", 8, True),
+        ])
+
+        entries = dbx.files_upload_session_finish_batch_v2.call_args.args[0]
+        assert sorted((e.commit.path, e.cursor.offset) for e in entries) == [("/d/large", 10), ("/d/small", 3)]
+
+# Test that chunk appends log lazily at DEBUG with periodic INFO progress
+def test_upload_session_logging(monkeypatch, caplog):
+    monkeypatch.setattr(backup, "CHUNK_SIZE", 4)
+    monkeypatch.setattr(backup, "PROGRESS_LOG_CHUNKS", 2)
+    caplog.set_level(logging.DEBUG, logger=backup.logger.name)
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file.write(b"0123456789abcdef01")
+        temp_file.close()
+
+        dbx = MagicMock()
+        dbx.clone.return_value = dbx
+        DropboxClient(dbx)._upload_session(temp_file.name, "s1")
+
+        appends = [r for r in caplog.records if r.msg.startswith("Appending")]
+        assert [r.levelno for r in appends] == [logging.DEBUG] * 5
+        assert [r.args for r in appends] == [(temp_file.name, offset) for offset in (0, 4, 8, 12, 16)]
+
+        progress = [r.getMessage() for r in caplog.records if r.levelno == logging.INFO]
+        assert progress == [
+            f"Uploading {temp_file.name}: 8 of 18 bytes",
+            f"Uploading {temp_file.name}: 16 of 18 bytes",
+        ]
+        os.remove(temp_file.name)
+
+# Test that the logger writes through the queue listener
+def test_logger_uses_queue(monkeypatch):
+    assert backup_logger.logger.handlers == [backup_logger.queue_handler]
+    assert isinstance(backup_logger.queue_handler, logging.handlers.QueueHandler)
+
+    handled = threading.Event()
+    monkeypatch.setattr(backup_logger.stderr_handler, "handle", lambda record: handled.set())
+    backup_logger.logger.error("queued record")
+    assert handled.wait(timeout=5)
+
+# Test that SIGTERM raises SystemExit so atexit handlers flush the log queue
+def test_handle_sigterm():
+    with pytest.raises(SystemExit) as exc_info:
+        backup.handle_sigterm(signal.SIGTERM, None)
+    assert exc_info.value.code == 0
+
+# Test that upload_batch reports files whose upload session fails
+def test_upload_batch_api_error(caplog):
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file.write(b"test data")
+        temp_file.close()
+
+        dbx = MagicMock()
+        dbx.clone.return_value = dbx
+        dbx.files_upload_session_start_batch.return_value.session_ids = ["s1"]
+        dbx.files_upload_session_append_v2.side_effect = ApiError(
+            "request-id", UploadSessionAppendError.not_found, None, None)
+
+        assert DropboxClient(dbx).upload_batch([(temp_file.name, "/d/file")]) == {}
+        dbx.files_upload_session_finish_batch_v2.assert_not_called()
+        assert "upload session not found" in caplog.text
+        os.remove(temp_file.name)
+
+# Test the remaining append error messages
+@pytest.mark.parametrize("error, user_message, expected", [
+    (UploadSessionAppendError.incorrect_offset(UploadSessionOffsetError(4)), None, "incorrect upload session offset"),
+    (UploadSessionAppendError.closed, "Session closed", "Session closed"),
+    (UploadSessionAppendError.too_large, None, "too_large"),
+])
+def test_upload_batch_append_error_messages(caplog, error, user_message, expected):
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file.write(b"test data")
+        temp_file.close()
+
+        dbx = MagicMock()
+        dbx.clone.return_value = dbx
+        dbx.files_upload_session_start_batch.return_value.session_ids = ["s1"]
+        dbx.files_upload_session_append_v2.side_effect = ApiError("request-id", error, user_message, None)
+
+        assert DropboxClient(dbx).upload_batch([(temp_file.name, "/d/file")]) == {}
+        assert f"Failed to upload {temp_file.name}: " in caplog.text
+        assert expected in caplog.text
+        os.remove(temp_file.name)
+
+# Test that commit failures from the finish batch are reported
+def test_upload_batch_finish_error(caplog):
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file.write(b"test data")
+        temp_file.close()
+
+        dbx = MagicMock()
+        dbx.clone.return_value = dbx
+        dbx.files_upload_session_start_batch.return_value.session_ids = ["s1"]
+        dbx.files_upload_session_finish_batch_v2.return_value = UploadSessionFinishBatchResult([
+            UploadSessionFinishBatchResultEntry.failure(UploadSessionFinishError.path(WriteError.insufficient_space)),
+        ])
+
+        assert DropboxClient(dbx).upload_batch([(temp_file.name, "/d/file")]) == {}
+        assert "insufficient space" in caplog.text
+
+        # Other commit failures name the file
+        caplog.clear()
+        dbx.files_upload_session_finish_batch_v2.return_value = UploadSessionFinishBatchResult([
+            UploadSessionFinishBatchResultEntry.failure(UploadSessionFinishError.path(WriteError.disallowed_name)),
+        ])
+        assert DropboxClient(dbx).upload_batch([(temp_file.name, "/d/file")]) == {}
+        assert f"Failed to commit {temp_file.name}" in caplog.text
+        assert "insufficient space" not in caplog.text
+        os.remove(temp_file.name)
+
+# Test that network and SDK errors are logged, keeping earlier batches' results
+def test_upload_batch_network_errors(monkeypatch, caplog):
+    monkeypatch.setattr(backup, "FINISH_BATCH_SIZE", 1)
     with tempfile.TemporaryDirectory() as temp_dir:
         file1_path = os.path.join(temp_dir, "file1")
         file2_path = os.path.join(temp_dir, "file2")
-        checksums_file = os.path.join(temp_dir, "checksums.txt")
-        
-        with open(file1_path, "w") as f:
-            f.write("test data 1")
-        with open(file2_path, "w") as f:
-            f.write("test data 2")
-        with open(checksums_file, "w") as f:
-            f.write(f"file1 {backup.calculate_md5(file1_path)}\n")
-
-        dropbox_client = MagicMock()
-
-        # Mock environment variables
-        backup.WATCH_FOLDER = temp_dir
-        backup.DROPBOX_FOLDER = "/dropbox_folder"
-
-        backup.monitor_and_upload(dropbox_client)
-
-        # Ensure that file2 was uploaded
-        dropbox_client.upload.assert_any_call(file2_path, os.path.join("/dropbox_folder", "file2"))
-        
-        # Ensure that checksums.txt was uploaded
-        dropbox_client.upload.assert_any_call(checksums_file, os.path.join("/dropbox_folder", "checksums.txt"))
-        
-        # Ensure checksums.txt is updated with new checksums
-        with open(checksums_file, "r") as f:
-            lines = f.readlines()
-            assert len(lines) == 3
-            splits = [x.split(" ")[0] for x in lines]
-            assert "checksums.txt" in splits
-            assert "file1" in splits
-            assert "file2" in splits
+        with open(file1_path, "wb") as f:
+            f.write(b"test data 1")
+        with open(file2_path, "wb") as f:
+            f.write(b"test data 2")
+
+        dbx = MagicMock()
+        dbx.clone.return_value = dbx
+        dbx.files_upload_session_start_batch.return_value.session_ids = ["s1"]
+        dbx.files_upload_session_finish_batch_v2.side_effect = [
+            MagicMock(entries=[MagicMock(**{"is_failure.return_value": False})]),
+            InternalServerError("request-id", 500, "error"),
+        ]
+        items = [(file1_path, "/d/file1"), (file2_path, "/d/file2")]
+        assert DropboxClient(dbx).upload_batch(items) == {file1_path: blake3.blake3(b"test data 1").hexdigest()}
+        assert "Failed to commit upload batch" in caplog.text
+
+        # Connection errors are upload failures, not read failures
+        caplog.clear()
+        dbx.files_upload_session_append_v2.side_effect = requests.ConnectionError("connection reset")
+        assert DropboxClient(dbx).upload_batch(items) == {}
+        assert f"Failed to upload {file1_path}" in caplog.text
+        assert "Cannot read" not in caplog.text
+
+        dbx.files_upload_session_start_batch.side_effect = InternalServerError("request-id", 500, "error")
+        assert DropboxClient(dbx).upload_batch(items) == {}
+
+# Test read_ignore function
+def test_read_ignore():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file.write(b"# comment\nfile1\nfile2 \n\n./file1\n")
+        temp_file.close()
+        assert read_ignore(temp_file.name) == {"file1", "file2"}
+        os.remove(temp_file.name)
+    assert read_ignore(temp_file.name) == frozenset()
+
+# Test that ignored files are skipped and a corrupt stat cache is rebuilt
+def test_monitor_and_upload_ignore(watch_folder, dropbox_client):
+    temp_dir = watch_folder
+    file1_path = os.path.join(temp_dir, "file1")
+    file2_path = os.path.join(temp_dir, "file2")
+    with open(file1_path, "w") as f:
+        f.write("test data 1")
+    with open(file2_path, "w") as f:
+        f.write("test data 2")
+    with open(os.path.join(temp_dir, "ignore.txt"), "w") as f:
+        f.write("file2\n")
+    age(file1_path)
+    with open(os.path.join(temp_dir, backup.STAT_CACHE_NAME), "w") as f:
+        f.write("not json")
+
+    backup.monitor_and_upload(dropbox_client)
+
+    file_paths = [file_path for file_path, _ in uploaded(dropbox_client)]
+    assert file1_path in file_paths
+    assert file2_path not in file_paths
+    assert "file1" in backup.read_stat_cache(os.path.join(temp_dir, backup.STAT_CACHE_NAME))
@@ -1,25 +1,12 @@
+from pathlib import Path
 from setuptools import setup, find_packages
 
-setup(
-    name='mypackage',
-    version='0.1',
-    packages=find_packages(),
-    entry_points={
-        'console_scripts': [
-            'mycommand = mypackage.myscript:main'
-        ]
-    },
-    install_requires=[
-        # List your project dependencies here.
-        # e.g., 'requests', 'boto3', etc.
-    ],
-)
-
-
-# Function to read the requirements from the requirements.txt file
-def load_requirements(filename='requirements.txt'):
-    with open(filename, 'r') as file:
-        return file.read().splitlines()
+# Requirements are read once, skipping blank lines and comments
+REQUIREMENTS_FILE = Path(__file__).resolve().parent / 'backup-docker' / 'requirements.txt'
+REQUIREMENTS = [
+    line.strip() for line in REQUIREMENTS_FILE.read_text().splitlines()
+    if line.strip() and not line.strip().startswith('#')
+]
 
 setup(
     name='mypackage',
@@ -30,5 +17,5 @@ setup(
             'mycommand = mypackage.myscript:main'
         ]
     },
-    install_requires=load_requirements(),
-)
\ No newline at end of file
+    install_requires=REQUIREMENTS,
+)